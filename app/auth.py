@@ -1,6 +1,7 @@
 from fastapi import Header, HTTPException, status, Security
 from fastapi.security import APIKeyHeader
 import os
+import hmac
 import logging
 
 logger = logging.getLogger(__name__)
@@ -8,6 +9,8 @@ logger = logging.getLogger(__name__)
 # API Key configuration
 API_KEY_HEADER_NAME = "X-API-Key"
 APP_API_KEY = os.getenv("APP_API_KEY")
+# Encoded once for constant-time comparison (compare_digest rejects non-ASCII str)
+APP_API_KEY_BYTES = APP_API_KEY.encode() if APP_API_KEY else b""
 
 # Create API Key header security scheme
 api_key_header = APIKeyHeader(name=API_KEY_HEADER_NAME, auto_error=False)
@@ -42,9 +45,10 @@ def verify_api_key(api_key: str = Security(api_key_header)) -> str:
             headers={"WWW-Authenticate": "ApiKey"},
         )
     
-    # Validate API key
-    if api_key != APP_API_KEY:
-        logger.warning(f"Invalid API key attempted: {api_key[:8]}...")
+    # Validate API key (constant-time comparison to avoid leaking key prefixes)
+    if not hmac.compare_digest(api_key.encode(), APP_API_KEY_BYTES):
+        if logger.isEnabledFor(logging.WARNING):
+            logger.warning("Invalid API key attempted: %s...", api_key[:8])
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid API key",
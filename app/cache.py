@@ -1,7 +1,8 @@
-from redis import Redis
-from typing import Optional
+from redis.asyncio import BlockingConnectionPool, Redis
+from typing import Optional, Set
 import os
-import json
+import uuid
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
@@ -15,23 +16,60 @@ REDIS_PASSWORD = os.getenv("REDIS_PASSWORD", None)
 # Cache TTL in seconds (24 hours)
 CACHE_TTL = int(os.getenv("CACHE_TTL", "86400"))
 
+# Prefix stored in front of every cached response body; bump it whenever the
+# response schema changes so entries written by older code are ignored
+CACHE_FORMAT_VERSION = b"v1:"
+
+# Lifetime in seconds of the lock held by an in-flight request for an idempotency key
+IDEMPOTENCY_LOCK_TTL = int(os.getenv("IDEMPOTENCY_LOCK_TTL", "10"))
+
+# Interval in seconds between cache polls while waiting on another request's lock
+IDEMPOTENCY_LOCK_POLL_INTERVAL = 0.05
+
+# Maximum number of pooled Redis connections per process
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", "50"))
+
+# Seconds a caller waits for a free pooled connection before giving up
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "1"))
+
+# Connection pool shared by every caller in this process, so each request
+# reuses an open connection instead of reconnecting (and re-authenticating).
+# When all connections are busy, callers wait briefly for one instead of
+# failing, so a burst does not look like a Redis outage and skip the
+# idempotency lock.
+_pool = BlockingConnectionPool(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    db=REDIS_DB,
+    password=REDIS_PASSWORD,
+    socket_connect_timeout=5,
+    socket_timeout=5,
+    max_connections=REDIS_POOL_SIZE,
+    timeout=REDIS_POOL_TIMEOUT
+)
+_redis = Redis(connection_pool=_pool)
+
+# Delete the lock only while it still holds the caller's token, so a holder
+# whose lock already expired cannot release a newer request's lock
+_release_lock_script = _redis.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then "
+    "return redis.call('del', KEYS[1]) end "
+    "return 0"
+)
+
+# Strong references to fire-and-forget cache writes so they are not garbage
+# collected before they finish
+_background_tasks: Set[asyncio.Task] = set()
+
 
 def get_redis_client() -> Redis:
     """
-    Get Redis client instance.
+    Get the shared Redis client instance.
     
     Returns:
-        Redis: Redis client instance
-    """
-    return Redis(
-        host=REDIS_HOST,
-        port=REDIS_PORT,
-        db=REDIS_DB,
-        password=REDIS_PASSWORD,
-        decode_responses=True,
-        socket_connect_timeout=5,
-        socket_timeout=5
-    )
+        Redis: Redis client backed by the module-level connection pool
+    """
+    return _redis
 
 
 def get_cache_key(idempotency_key: str) -> str:
@@ -47,63 +85,214 @@ def get_cache_key(idempotency_key: str) -> str:
     return f"idempotency:{idempotency_key}"
 
 
-def get_cached_transaction(idempotency_key: str) -> Optional[dict]:
+def get_lock_key(idempotency_key: str) -> str:
+    """
+    Generate lock key for idempotency key.
+    
+    Args:
+        idempotency_key: UUID string of the idempotency key
+        
+    Returns:
+        str: Lock key
+    """
+    return f"idempotency:{idempotency_key}:lock"
+
+
+def _unpack_cached_value(cached_data: Optional[bytes]) -> Optional[bytes]:
+    """
+    Strip the format version prefix from a cached value.
+    
+    Args:
+        cached_data: Raw value read from Redis
+        
+    Returns:
+        Optional[bytes]: Response body, or None if missing or written in another format
+    """
+    if cached_data and cached_data.startswith(CACHE_FORMAT_VERSION):
+        return cached_data[len(CACHE_FORMAT_VERSION):]
+    return None
+
+
+async def get_cached_transaction(idempotency_key: str) -> Optional[bytes]:
     """
-    Retrieve cached transaction from Redis.
+    Retrieve cached transaction response from Redis.
     
     Args:
         idempotency_key: UUID string of the idempotency key
         
     Returns:
-        Optional[dict]: Cached transaction data if found, None otherwise
+        Optional[bytes]: Cached JSON response body if found, None otherwise
     """
     try:
         redis_client = get_redis_client()
         cache_key = get_cache_key(idempotency_key)
-        cached_data = redis_client.get(cache_key)
+        cached_body = _unpack_cached_value(await redis_client.get(cache_key))
         
-        if cached_data:
-            logger.debug(f"Cache hit for Idempotency-Key={idempotency_key}")
-            return json.loads(cached_data)
+        if cached_body:
+            logger.debug("Cache hit for Idempotency-Key=%s", idempotency_key)
+            return cached_body
         else:
-            logger.debug(f"Cache miss for Idempotency-Key={idempotency_key}")
+            logger.debug("Cache miss for Idempotency-Key=%s", idempotency_key)
             return None
     except Exception as e:
         # Log error but don't fail the request - fall back to database
-        logger.warning(f"Redis cache error: {str(e)}. Falling back to database.")
+        logger.warning("Redis cache error: %s. Falling back to database.", e)
         return None
 
 
-def cache_transaction(idempotency_key: str, transaction_data: dict) -> bool:
+def cache_transaction(
+    idempotency_key: str, response_body: bytes, lock_token: Optional[str]
+) -> None:
+    """
+    Cache transaction result in Redis without waiting for the write.
+    
+    The write is scheduled on the running event loop so the response is not
+    delayed by a Redis round-trip. The same pipeline releases the idempotency
+    lock, so waiting requests see the result before they see the lock gone.
+    
+    Args:
+        idempotency_key: UUID string of the idempotency key
+        response_body: Serialized JSON response body
+        lock_token: Token returned by acquire_idempotency_lock, or None if
+            this request does not hold the lock
+    """
+    if not idempotency_key:
+        return
+    
+    task = asyncio.create_task(
+        _store_transaction(idempotency_key, response_body, lock_token)
+    )
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _store_transaction(
+    idempotency_key: str, response_body: bytes, lock_token: Optional[str]
+) -> bool:
     """
-    Cache transaction result in Redis.
+    Store transaction result in Redis and release the idempotency lock.
     
     Args:
         idempotency_key: UUID string of the idempotency key
-        transaction_data: Dictionary containing transaction response data
+        response_body: Serialized JSON response body
+        lock_token: Token returned by acquire_idempotency_lock, or None if
+            this request does not hold the lock
         
     Returns:
         bool: True if cached successfully, False otherwise
     """
-    if not idempotency_key:
-        return False
-        
     try:
         redis_client = get_redis_client()
         cache_key = get_cache_key(idempotency_key)
         
-        # Serialize transaction data to JSON
-        cached_value = json.dumps(transaction_data)
+        # Prefix with the format version so schema changes invalidate old entries
+        cached_value = CACHE_FORMAT_VERSION + response_body
         
-        # Store with TTL
-        redis_client.setex(cache_key, CACHE_TTL, cached_value)
+        # Store with TTL, then release the lock if this request still holds it
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.setex(cache_key, CACHE_TTL, cached_value)
+        if lock_token is not None:
+            await _release_lock_script(
+                keys=[get_lock_key(idempotency_key)], args=[lock_token], client=pipe
+            )
+        await pipe.execute()
         logger.info(
-            f"Cached transaction for Idempotency-Key={idempotency_key}, "
-            f"TTL={CACHE_TTL}s"
+            "Cached transaction for Idempotency-Key=%s, TTL=%ss",
+            idempotency_key, CACHE_TTL
         )
         return True
     except Exception as e:
         # Log error but don't fail the request
-        logger.warning(f"Failed to cache transaction in Redis: {str(e)}")
+        logger.warning("Failed to cache transaction in Redis: %s", e)
         return False
 
+
+async def acquire_idempotency_lock(idempotency_key: str) -> Optional[str]:
+    """
+    Try to become the only request processing an idempotency key.
+    
+    Uses SET NX with a TTL so a crashed holder cannot block the key forever.
+    The lock value is a token unique to this request, so only the holder
+    can release it.
+    
+    Args:
+        idempotency_key: UUID string of the idempotency key
+        
+    Returns:
+        Optional[str]: Lock token if the lock was acquired (or Redis is
+        unavailable), None if another request already holds it
+    """
+    lock_token = uuid.uuid4().hex
+    try:
+        redis_client = get_redis_client()
+        acquired = await redis_client.set(
+            get_lock_key(idempotency_key), lock_token, nx=True, ex=IDEMPOTENCY_LOCK_TTL
+        )
+        return lock_token if acquired else None
+    except Exception as e:
+        # Fail open - the database still guarantees idempotency
+        logger.warning("Failed to acquire idempotency lock in Redis: %s", e)
+        return lock_token
+
+
+async def release_idempotency_lock(idempotency_key: str, lock_token: str) -> None:
+    """
+    Release the lock taken by acquire_idempotency_lock.
+    
+    Only needed when no result was cached; cache_transaction releases the
+    lock itself. The lock is left alone if it expired and another request
+    now holds it.
+    
+    Args:
+        idempotency_key: UUID string of the idempotency key
+        lock_token: Token returned by acquire_idempotency_lock
+    """
+    try:
+        await _release_lock_script(
+            keys=[get_lock_key(idempotency_key)], args=[lock_token]
+        )
+    except Exception as e:
+        # The lock expires on its own after IDEMPOTENCY_LOCK_TTL
+        logger.warning("Failed to release idempotency lock in Redis: %s", e)
+
+
+async def wait_for_cached_transaction(idempotency_key: str) -> Optional[bytes]:
+    """
+    Wait for the request holding the idempotency lock to cache its result.
+    
+    Polls the cached result and the lock together in one round-trip. Stops as
+    soon as the result appears, the lock is released without a result (e.g.
+    the holder failed), or IDEMPOTENCY_LOCK_TTL elapses.
+    
+    Args:
+        idempotency_key: UUID string of the idempotency key
+        
+    Returns:
+        Optional[bytes]: Cached JSON response body if it appeared, None otherwise
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + IDEMPOTENCY_LOCK_TTL
+    cache_key = get_cache_key(idempotency_key)
+    lock_key = get_lock_key(idempotency_key)
+    
+    while True:
+        try:
+            redis_client = get_redis_client()
+            cached_data, locked = await (
+                redis_client.pipeline(transaction=False)
+                .get(cache_key)
+                .exists(lock_key)
+                .execute()
+            )
+        except Exception as e:
+            logger.warning("Redis cache error: %s. Falling back to database.", e)
+            return None
+        
+        cached_body = _unpack_cached_value(cached_data)
+        if cached_body:
+            logger.debug("Cache hit after waiting for Idempotency-Key=%s", idempotency_key)
+            return cached_body
+        if not locked or loop.time() >= deadline:
+            return None
+        
+        await asyncio.sleep(IDEMPOTENCY_LOCK_POLL_INTERVAL)
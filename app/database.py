@@ -1,35 +1,61 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base, Session
-from typing import Generator
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
+from typing import AsyncGenerator
 import os
 
 DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://postgres:postgres@db:5432/picopay")
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# The application talks to PostgreSQL through asyncpg; accept plain
+# postgresql:// URLs (shared with the sync helper scripts) and pick the driver here
+if DATABASE_URL.startswith("postgresql://"):
+    DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+# Connection pool sizing (per worker process)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+
+# Statement timeout in milliseconds, applied to every pooled connection
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+
+engine = create_async_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_recycle=3600,
+    pool_pre_ping=True,
+    connect_args={"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}}
+)
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
 
-def get_db() -> Generator[Session, None, None]:
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
     """
     FastAPI dependency for database session management.
     
-    Yields a database session and ensures proper cleanup after the request.
+    Yields an async database session and ensures proper cleanup after the request.
     This follows FastAPI's dependency injection best practices using yield.
     
     Yields:
-        Session: SQLAlchemy database session
+        AsyncSession: SQLAlchemy async database session
         
     Example:
         @app.post("/endpoint")
-        async def endpoint(db: Session = Depends(get_db)):
+        async def endpoint(db: AsyncSession = Depends(get_db)):
             # Use db here
             pass
     """
-    db: Session = SessionLocal()
-    try:
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
+
+async def create_tables() -> None:
+    """
+    Create all tables defined on Base that do not exist yet.
+    
+    Intended for development and first-time setup; production schemas should
+    be applied once by a migration step rather than on every process start.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
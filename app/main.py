@@ -1,13 +1,24 @@
 from fastapi import FastAPI, Depends, HTTPException, status, Request, Response
-from sqlalchemy.orm import Session
-from sqlalchemy.exc import IntegrityError
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import bindparam, select, text
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.asyncio import AsyncSession
+from decimal import Decimal
+import orjson
 import uuid
 import logging
 import time
-from app.database import get_db, engine, Base
+import os
+from app.database import get_db, create_tables
 from app.models import User, Transaction, TransactionStatus
 from app.schemas import ChargeRequest, ChargeResponse, ErrorResponse, TransactionResponse
-from app.cache import get_cached_transaction, cache_transaction
+from app.cache import (
+    get_cached_transaction,
+    cache_transaction,
+    acquire_idempotency_lock,
+    release_idempotency_lock,
+    wait_for_cached_transaction,
+)
 from app.auth import verify_api_key
 from app.metrics import record_charge_request, get_metrics
 from prometheus_client import CONTENT_TYPE_LATEST
@@ -22,10 +33,102 @@ logger = logging.getLogger(__name__)
 app = FastAPI(title="PicoPay Payment Engine", version="1.0.0")
 
 
+# Statements used by /charge, built once at import so requests do not rebuild
+# SQL expressions; SQLAlchemy's compiled cache reuses their rendered SQL.
+
+# Insert the transaction and debit the balance in a single statement.
+# ON CONFLICT makes a concurrent request with the same idempotency_key wait
+# for the first one and then insert nothing; the debit only runs if the
+# insert happened and the balance covers the amount.
+CHARGE_STATEMENT = text("""
+    WITH ins AS (
+        INSERT INTO transactions (user_id, amount, currency, status, idempotency_key)
+        SELECT id, CAST(:amount AS numeric(18, 2)), CAST(:currency AS varchar),
+               CAST('COMPLETED' AS transactionstatus), :idempotency_key
+        FROM users
+        WHERE id = :user_id
+        ON CONFLICT (idempotency_key) WHERE idempotency_key IS NOT NULL DO NOTHING
+        RETURNING id
+    ), upd AS (
+        UPDATE users
+        SET balance = balance - CAST(:amount AS numeric(18, 2))
+        WHERE id = :user_id
+          AND balance >= CAST(:amount AS numeric(18, 2))
+          AND EXISTS (SELECT 1 FROM ins)
+        RETURNING balance
+    )
+    SELECT (SELECT id FROM ins) AS transaction_id,
+           (SELECT balance FROM upd) AS new_balance
+""").bindparams(bindparam("idempotency_key", type_=UUID(as_uuid=True)))
+
+# Existing transaction for an idempotency key, with the user's current balance
+SELECT_TRANSACTION_BY_IDEMPOTENCY_KEY = (
+    select(
+        Transaction.id,
+        Transaction.user_id,
+        Transaction.amount,
+        Transaction.currency,
+        Transaction.status,
+        Transaction.idempotency_key,
+        User.balance
+    )
+    .join(User, Transaction.user_id == User.id)
+    .where(Transaction.idempotency_key == bindparam("idempotency_key"))
+)
+
+SELECT_USER_BALANCE = select(User.balance).where(User.id == bindparam("user_id"))
+
+
+# Create missing tables on startup only when explicitly enabled (development);
+# in production the schema is managed by a migration step
+APP_AUTO_CREATE = os.getenv("APP_AUTO_CREATE", "0") == "1"
+
+
 @app.on_event("startup")
 async def startup_event():
-    """Create database tables on startup"""
-    Base.metadata.create_all(bind=engine)
+    """Create database tables on startup if APP_AUTO_CREATE=1"""
+    if APP_AUTO_CREATE:
+        await create_tables()
+
+
+def _build_response(transaction: dict, new_balance: Decimal, message: str) -> ChargeResponse:
+    """
+    Build the /charge response for a transaction.
+    
+    The fields come from the database or from an already validated
+    ChargeRequest, so the models are built with model_construct and skip
+    Pydantic validation. The handler returns the serialized body directly,
+    so FastAPI does not validate it against response_model either.
+    
+    Args:
+        transaction: Transaction fields matching TransactionResponse
+        new_balance: User balance after the transaction
+        message: Human-readable result message
+        
+    Returns:
+        ChargeResponse: Response model returned to the client
+    """
+    return ChargeResponse.model_construct(
+        message=message,
+        transaction=TransactionResponse.model_construct(**transaction),
+        new_balance=new_balance
+    )
+
+
+def _serialize_response(response: ChargeResponse) -> bytes:
+    """
+    Serialize a /charge response into its JSON body.
+    
+    The same bytes are sent to the client and stored in Redis, so cache
+    hits can return them without parsing or validating anything.
+    
+    Args:
+        response: Response returned for the original request
+        
+    Returns:
+        bytes: JSON response body
+    """
+    return orjson.dumps(jsonable_encoder(response))
 
 
 @app.get("/")
@@ -53,12 +156,14 @@ async def metrics():
 async def charge(
     charge_request: ChargeRequest,
     request: Request,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     api_key: str = Depends(verify_api_key)
 ):
     """
     Process a charge transaction atomically.
     Deducts the amount from user's balance and creates a transaction record.
+    The debit is a conditional UPDATE (balance >= amount) evaluated by PostgreSQL,
+    so no row lock is held across application code.
     If balance is insufficient, returns 400 Bad Request and rolls back the transaction.
     
     Requires API key authentication via X-API-Key header.
@@ -69,7 +174,7 @@ async def charge(
     Uses Redis cache for fast idempotency lookups before querying PostgreSQL.
     """
     # Start timing for metrics
-    start_time = time.time()
+    start_time = time.perf_counter()
     
     # Extract Idempotency-Key from header if present
     idempotency_key_str = request.headers.get("Idempotency-Key")
@@ -78,197 +183,161 @@ async def charge(
         try:
             idempotency_key = uuid.UUID(idempotency_key_str)
         except ValueError:
-            duration = time.time() - start_time
+            duration = time.perf_counter() - start_time
             record_charge_request('failed', duration)
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Invalid Idempotency-Key format. Must be a valid UUID."
             )
+        # Canonical form of the key, formatted once and reused for every Redis call
+        idempotency_key_str = str(idempotency_key)
     
     # Check Redis cache first for idempotency key
+    lock_token = None
     if idempotency_key:
-        cached_result = get_cached_transaction(str(idempotency_key))
+        cached_result = await get_cached_transaction(idempotency_key_str)
+        if not cached_result:
+            # Only one request per idempotency key goes to the database;
+            # concurrent retries wait for its cached result instead
+            lock_token = await acquire_idempotency_lock(idempotency_key_str)
+            if lock_token is None:
+                cached_result = await wait_for_cached_transaction(idempotency_key_str)
         if cached_result:
-            # Cache hit - return cached response immediately without touching database
-            # Reconstruct the response from cached data
-            transaction_data = cached_result.get('transaction', {})
-            logger.info(
-                f"Cache hit: Idempotency-Key={idempotency_key}, "
-                f"Returned Transaction ID={transaction_data.get('id')}"
-            )
-            
-            # Convert status string back to enum
-            status_enum = TransactionStatus(transaction_data.get('status'))
-            # Convert idempotency_key string back to UUID if present
-            cached_idempotency_key = None
-            if transaction_data.get('idempotency_key'):
-                cached_idempotency_key = uuid.UUID(transaction_data.get('idempotency_key'))
+            # Cache hit - return cached response immediately without touching database.
+            # The cached bytes are the serialized body of the original response,
+            # so they are sent as-is instead of being parsed and re-validated
+            logger.info("Cache hit: Idempotency-Key=%s", idempotency_key)
             
             # Record metrics for idempotent hit
-            duration = time.time() - start_time
+            duration = time.perf_counter() - start_time
             record_charge_request('idempotent_hit', duration)
             
-            return ChargeResponse(
-                message=cached_result.get('message', 'Charge processed successfully (idempotent)'),
-                transaction=TransactionResponse(
-                    id=transaction_data.get('id'),
-                    user_id=transaction_data.get('user_id'),
-                    amount=transaction_data.get('amount'),
-                    currency=transaction_data.get('currency'),
-                    status=status_enum,
-                    idempotency_key=cached_idempotency_key
-                ),
-                new_balance=cached_result.get('new_balance', 0.0)
-            )
+            return Response(content=cached_result, media_type="application/json")
     
     # Cache miss or no idempotency key - proceed with database transaction
     # Start a database transaction
     try:
-        # Check for existing transaction with the same idempotency_key within the transaction
-        # This ensures concurrency safety - we lock the row if it exists
-        if idempotency_key:
-            existing_transaction = (
-                db.query(Transaction)
-                .filter(Transaction.idempotency_key == idempotency_key)
-                .with_for_update()
-                .first()
-            )
+        # Insert the transaction and debit the balance in one round-trip
+        result = await db.execute(
+            CHARGE_STATEMENT,
+            {
+                "user_id": charge_request.user_id,
+                "amount": charge_request.amount,
+                "currency": charge_request.currency,
+                "idempotency_key": idempotency_key
+            }
+        )
+        row = result.mappings().first()
+        
+        if row["transaction_id"] is None:
+            # Nothing was inserted: either the idempotency_key already exists
+            # or the user does not exist
+            await db.rollback()
             
-            # If a completed transaction exists, return it immediately
-            if existing_transaction and existing_transaction.status == TransactionStatus.COMPLETED:
-                # Get the user's current balance (which should match the balance after this transaction)
-                user = db.query(User).filter(User.id == existing_transaction.user_id).first()
-                
-                # Log idempotency hit
-                logger.info(
-                    f"Idempotency hit: Idempotency-Key={idempotency_key}, "
-                    f"Returned Transaction ID={existing_transaction.id}"
-                )
-                
-                # Build response
-                response = ChargeResponse(
-                    message="Charge processed successfully (idempotent)",
-                    transaction=TransactionResponse(
-                        id=existing_transaction.id,
-                        user_id=existing_transaction.user_id,
-                        amount=existing_transaction.amount,
-                        currency=existing_transaction.currency,
-                        status=existing_transaction.status,
-                        idempotency_key=existing_transaction.idempotency_key
-                    ),
-                    new_balance=user.balance if user else 0.0
+            if idempotency_key:
+                # Fetch the existing transaction together with the user's current
+                # balance (which should match the balance after this transaction)
+                result = await db.execute(
+                    SELECT_TRANSACTION_BY_IDEMPOTENCY_KEY,
+                    {"idempotency_key": idempotency_key}
                 )
+                existing = result.mappings().first()
                 
-                # Cache the result for future requests
-                cache_data = {
-                    "message": response.message,
-                    "transaction": {
-                        "id": response.transaction.id,
-                        "user_id": response.transaction.user_id,
-                        "amount": response.transaction.amount,
-                        "currency": response.transaction.currency,
-                        "status": response.transaction.status.value,
-                        "idempotency_key": str(response.transaction.idempotency_key) if response.transaction.idempotency_key else None
-                    },
-                    "new_balance": response.new_balance
-                }
-                cache_transaction(str(idempotency_key), cache_data)
-                
-                return response
-        
-        # Lock the user row for update to prevent race conditions
-        user = db.query(User).filter(User.id == charge_request.user_id).with_for_update().first()
-        
-        if not user:
-            duration = time.time() - start_time
-            record_charge_request('failed', duration)
+                # If a completed transaction exists, return it immediately
+                if existing and existing["status"] == TransactionStatus.COMPLETED:
+                    existing_transaction = dict(existing)
+                    user_balance = existing_transaction.pop("balance")
+                    
+                    # Log idempotency hit
+                    logger.info(
+                        "Idempotency hit: Idempotency-Key=%s, Returned Transaction ID=%s",
+                        idempotency_key, existing_transaction["id"]
+                    )
+                    
+                    # Build response
+                    response = _build_response(
+                        existing_transaction,
+                        user_balance,
+                        "Charge processed successfully (idempotent)"
+                    )
+                    
+                    body = _serialize_response(response)
+                    
+                    # Cache the result for future requests
+                    cache_transaction(idempotency_key_str, body, lock_token)
+                    # The cache write releases the lock once the result is stored
+                    lock_token = None
+                    
+                    # Record metrics for idempotent hit
+                    duration = time.perf_counter() - start_time
+                    record_charge_request('idempotent_hit', duration)
+                    
+                    return Response(content=body, media_type="application/json")
+            
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"User with id {charge_request.user_id} not found"
             )
         
-        # Check if balance is sufficient
-        if user.balance < charge_request.amount:
+        if row["new_balance"] is None:
+            # The user exists but the conditional debit matched no row
+            await db.rollback()
+            current_balance = await db.scalar(
+                SELECT_USER_BALANCE, {"user_id": charge_request.user_id}
+            )
             # Log insufficient balance failure
             logger.info(
-                f"Insufficient balance failure: User ID={charge_request.user_id}, "
-                f"Requested Amount={charge_request.amount}"
+                "Insufficient balance failure: User ID=%s, Requested Amount=%s",
+                charge_request.user_id, charge_request.amount
             )
-            # Rollback the transaction explicitly
-            db.rollback()
             # Record metrics for insufficient balance
-            duration = time.time() - start_time
+            duration = time.perf_counter() - start_time
             record_charge_request('insufficient_balance', duration)
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Insufficient balance. Current balance: {user.balance}, Required: {charge_request.amount}"
+                detail=f"Insufficient balance. Current balance: {current_balance}, Required: {charge_request.amount}"
             )
         
-        # Deduct the amount from user's balance
-        user.balance -= charge_request.amount
-        
-        # Create transaction record
-        transaction = Transaction(
-            user_id=charge_request.user_id,
-            amount=charge_request.amount,
-            currency=charge_request.currency,
-            status=TransactionStatus.COMPLETED,
-            idempotency_key=idempotency_key
-        )
-        db.add(transaction)
-        
         # Commit the transaction atomically
-        db.commit()
-        
-        # Refresh to get the latest data
-        db.refresh(transaction)
-        db.refresh(user)
+        await db.commit()
         
         # Log successful new charge
         logger.info(
-            f"Successful new charge: Transaction ID={transaction.id}, "
-            f"User ID={transaction.user_id}"
+            "Successful new charge: Transaction ID=%s, User ID=%s",
+            row["transaction_id"], charge_request.user_id
         )
         
         # Build response
-        response = ChargeResponse(
-            message="Charge processed successfully",
-            transaction=TransactionResponse(
-                id=transaction.id,
-                user_id=transaction.user_id,
-                amount=transaction.amount,
-                currency=transaction.currency,
-                status=transaction.status,
-                idempotency_key=transaction.idempotency_key
-            ),
-            new_balance=user.balance
+        response = _build_response(
+            {
+                "id": row["transaction_id"],
+                "user_id": charge_request.user_id,
+                "amount": charge_request.amount,
+                "currency": charge_request.currency,
+                "status": TransactionStatus.COMPLETED,
+                "idempotency_key": idempotency_key
+            },
+            row["new_balance"],
+            "Charge processed successfully"
         )
         
+        body = _serialize_response(response)
+        
         # Cache the successful transaction result in Redis
         if idempotency_key:
-            cache_data = {
-                "message": response.message,
-                "transaction": {
-                    "id": response.transaction.id,
-                    "user_id": response.transaction.user_id,
-                    "amount": response.transaction.amount,
-                    "currency": response.transaction.currency,
-                    "status": response.transaction.status.value,
-                    "idempotency_key": str(response.transaction.idempotency_key) if response.transaction.idempotency_key else None
-                },
-                "new_balance": response.new_balance
-            }
-            cache_transaction(str(idempotency_key), cache_data)
+            cache_transaction(idempotency_key_str, body, lock_token)
+            # The cache write releases the lock once the result is stored
+            lock_token = None
         
         # Record metrics for successful charge
-        duration = time.time() - start_time
+        duration = time.perf_counter() - start_time
         record_charge_request('success', duration)
         
-        return response
+        return Response(content=body, media_type="application/json")
         
     except HTTPException as e:
         # Record metrics for failed requests (HTTP exceptions)
-        duration = time.time() - start_time
+        duration = time.perf_counter() - start_time
         # Determine status based on HTTP status code
         if e.status_code == status.HTTP_400_BAD_REQUEST:
             # Could be insufficient balance or invalid request
@@ -280,76 +349,16 @@ async def charge(
             record_charge_request('failed', duration)
         # Re-raise HTTP exceptions (they already have rollback)
         raise
-    except IntegrityError as e:
-        # Handle unique constraint violation (duplicate idempotency_key)
-        db.rollback()
-        if idempotency_key:
-            # If we get here, another request with the same key was processed concurrently
-            # Query again to get the completed transaction
-            existing_transaction = (
-                db.query(Transaction)
-                .filter(Transaction.idempotency_key == idempotency_key)
-                .first()
-            )
-            if existing_transaction and existing_transaction.status == TransactionStatus.COMPLETED:
-                user = db.query(User).filter(User.id == existing_transaction.user_id).first()
-                
-                # Log idempotency hit (from IntegrityError path)
-                logger.info(
-                    f"Idempotency hit: Idempotency-Key={idempotency_key}, "
-                    f"Returned Transaction ID={existing_transaction.id}"
-                )
-                
-                # Build response
-                response = ChargeResponse(
-                    message="Charge processed successfully (idempotent)",
-                    transaction=TransactionResponse(
-                        id=existing_transaction.id,
-                        user_id=existing_transaction.user_id,
-                        amount=existing_transaction.amount,
-                        currency=existing_transaction.currency,
-                        status=existing_transaction.status,
-                        idempotency_key=existing_transaction.idempotency_key
-                    ),
-                    new_balance=user.balance if user else 0.0
-                )
-                
-                # Cache the result for future requests
-                cache_data = {
-                    "message": response.message,
-                    "transaction": {
-                        "id": response.transaction.id,
-                        "user_id": response.transaction.user_id,
-                        "amount": response.transaction.amount,
-                        "currency": response.transaction.currency,
-                        "status": response.transaction.status.value,
-                        "idempotency_key": str(response.transaction.idempotency_key) if response.transaction.idempotency_key else None
-                    },
-                    "new_balance": response.new_balance
-                }
-                cache_transaction(str(idempotency_key), cache_data)
-                
-                # Record metrics for idempotent hit (from IntegrityError path)
-                duration = time.time() - start_time
-                record_charge_request('idempotent_hit', duration)
-                
-                return response
-        
-        # If we get here, it's a database integrity error that we can't handle
-        duration = time.time() - start_time
-        record_charge_request('failed', duration)
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Database integrity error: {str(e)}"
-        )
     except Exception as e:
         # Rollback on any other error
-        db.rollback()
+        await db.rollback()
         # Record metrics for failed requests
-        duration = time.time() - start_time
+        duration = time.perf_counter() - start_time
         record_charge_request('failed', duration)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An error occurred while processing the charge: {str(e)}"
         )
-
+    finally:
+        if lock_token is not None:
+            await release_idempotency_lock(idempotency_key_str, lock_token)
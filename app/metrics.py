@@ -11,14 +11,29 @@ charge_requests_total = Counter(
     ['status']  # Labels: 'success', 'failed', 'idempotent_hit', 'insufficient_balance'
 )
 
+# Pre-bound counter children for the fixed set of statuses, so recording a
+# request skips the per-call label lookup
+_charge_request_counters = {
+    status: charge_requests_total.labels(status=status)
+    for status in ('success', 'failed', 'idempotent_hit', 'insufficient_balance')
+}
+
 # Histogram for tracking charge request latency
 charge_request_latency_seconds = Histogram(
     'charge_request_latency_seconds',
     'Charge request latency in seconds',
-    buckets=[0.01, 0.05, 0.1, 0.5, 1.0, 2.0, 5.0, 10.0]  # Buckets in seconds
+    buckets=[0.05, 0.25, 1.0]  # Buckets in seconds; kept coarse to limit series per scrape
 )
 
 
+# Minimum age in seconds before the /metrics snapshot is regenerated; scrape
+# intervals are much longer, so scrapes rarely see stale data
+METRICS_SNAPSHOT_TTL = 1.0
+
+# (monotonic time generated, serialized registry) of the last /metrics snapshot
+_last_snapshot = (0.0, b"")
+
+
 def record_charge_request(status: str, duration: float):
     """
     Record charge request metrics.
@@ -27,17 +42,27 @@ def record_charge_request(status: str, duration: float):
         status: Request status ('success', 'failed', 'idempotent_hit', 'insufficient_balance')
         duration: Request duration in seconds
     """
-    charge_requests_total.labels(status=status).inc()
+    _charge_request_counters[status].inc()
     charge_request_latency_seconds.observe(duration)
-    logger.debug(f"Recorded metrics: status={status}, duration={duration:.4f}s")
+    logger.debug("Recorded metrics: status=%s, duration=%.4fs", status, duration)
 
 
 def get_metrics():
     """
     Get Prometheus metrics in text format.
     
+    Serializing the registry walks every metric under its lock, so the result
+    is reused for METRICS_SNAPSHOT_TTL seconds instead of being regenerated
+    on every scrape.
+    
     Returns:
         bytes: Prometheus metrics in text format
     """
-    return generate_latest()
+    global _last_snapshot
+    now = time.monotonic()
+    generated_at, snapshot = _last_snapshot
+    if not snapshot or now - generated_at > METRICS_SNAPSHOT_TTL:
+        snapshot = generate_latest()
+        _last_snapshot = (now, snapshot)
+    return snapshot
 
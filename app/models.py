@@ -1,6 +1,7 @@
-from sqlalchemy import ForeignKey, Enum, UniqueConstraint
+from sqlalchemy import ForeignKey, Enum, Index, Numeric
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import Mapped, mapped_column, relationship
+from decimal import Decimal
 from typing import List, Optional
 import enum
 import uuid
@@ -17,7 +18,7 @@ class User(Base):
     __tablename__ = "users"
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
-    balance: Mapped[float] = mapped_column(default=0.0)
+    balance: Mapped[Decimal] = mapped_column(Numeric(18, 2), default=Decimal("0.00"))
 
     transactions: Mapped[List["Transaction"]] = relationship(back_populates="user")
 
@@ -27,14 +28,23 @@ class Transaction(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
-    amount: Mapped[float] = mapped_column()
+    amount: Mapped[Decimal] = mapped_column(Numeric(18, 2))
     currency: Mapped[str] = mapped_column()
     status: Mapped[TransactionStatus] = mapped_column(
         Enum(TransactionStatus), default=TransactionStatus.PENDING
     )
     idempotency_key: Mapped[Optional[uuid.UUID]] = mapped_column(
-        UUID(as_uuid=True), unique=True, index=True, nullable=True
+        UUID(as_uuid=True), nullable=True
     )
 
     user: Mapped["User"] = relationship(back_populates="transactions")
 
+
+# Unique partial index backing idempotency lookups and ON CONFLICT; rows
+# without an idempotency key are left out of the index entirely
+Index(
+    "ix_tx_idem_notnull",
+    Transaction.idempotency_key,
+    unique=True,
+    postgresql_where=Transaction.idempotency_key.isnot(None),
+)
@@ -1,31 +1,35 @@
-from pydantic import BaseModel, Field
-from typing import Optional
+from pydantic import BaseModel, Field, PlainSerializer
+from decimal import Decimal
+from typing import Annotated, Optional
 import uuid
 from app.models import TransactionStatus
 
 
+# Money amounts are exact decimals internally but stay JSON numbers on the wire
+Money = Annotated[Decimal, PlainSerializer(float, return_type=float, when_used="json")]
+
+
 class ChargeRequest(BaseModel):
     user_id: int = Field(..., description="ID of the user making the charge")
-    amount: float = Field(..., gt=0, description="Amount to charge (must be positive)")
+    amount: Decimal = Field(
+        ..., gt=0, max_digits=18, decimal_places=2, description="Amount to charge (must be positive)"
+    )
     currency: str = Field(..., min_length=3, max_length=3, description="Currency code (3 characters)")
 
 
 class TransactionResponse(BaseModel):
     id: int
     user_id: int
-    amount: float
+    amount: Money
     currency: str
     status: TransactionStatus
     idempotency_key: Optional[uuid.UUID] = None
 
-    class Config:
-        from_attributes = True
-
 
 class ChargeResponse(BaseModel):
     message: str
     transaction: TransactionResponse
-    new_balance: float
+    new_balance: Money
 
 
 class ErrorResponse(BaseModel):